@@ -3,6 +3,7 @@
 Cliente MCP - Conecta con multiples servidores MCP via HTTP
 """
 import httpx
+import orjson
 import logging
 from config import MCP_SERVERS
 
@@ -12,6 +13,7 @@ logger = logging.getLogger(__name__)
 class MCPClient:
     def __init__(self):
         self.tools_cache = {}
+        self.total_tools = 0
         self.servers = MCP_SERVERS
         self.sessions = {}
         self._initialized = False
@@ -26,7 +28,7 @@ class MCPClient:
                 async with httpx.AsyncClient(timeout=30.0) as client:
                     response = await client.get(url)
                     if response.status_code == 200:
-                        data = response.json()
+                        data = orjson.loads(response.content)
                         tools = data.get("tools", [])
                         self.tools_cache[name] = tools
                         self.sessions[name] = True
@@ -38,6 +40,8 @@ class MCPClient:
                 logger.error(f"❌ {name}: {str(e)}")
                 self.tools_cache[name] = []
         
+        # Contador precalculado para /health (tools_cache solo cambia aqui)
+        self.total_tools = sum(len(tools) for tools in self.tools_cache.values())
         self._initialized = True
     
     async def get_all_tools(self):
@@ -75,7 +79,7 @@ class MCPClient:
                     }
                 )
                 if response.status_code == 200:
-                    data = response.json()
+                    data = orjson.loads(response.content)
                     return data.get("result", "OK")
                 else:
                     return f"Error HTTP {response.status_code}"
@@ -0,0 +1,74 @@
+"""
+Piezas compartidas por los servidores MCP (Shopify, Meta, Dropi, n8n):
+respuestas JSON con orjson, sobre JSON-RPC, tabla de metodos MCP y fecha de hoy.
+Un cambio aqui aplica a todos los servidores a la vez.
+"""
+
+import time
+import datetime
+import orjson
+from starlette.responses import JSONResponse
+
+PROTOCOL_VERSION = "2024-11-05"
+
+# Fecha de hoy cacheada: (YYYY-MM-DD, timestamp de la proxima medianoche)
+_today = ("", 0.0)
+
+def today_iso() -> str:
+    """Fecha local de hoy (YYYY-MM-DD); se recalcula solo al pasar la medianoche."""
+    global _today
+    iso, until = _today
+    if time.time() >= until:
+        today = datetime.date.today()
+        iso = today.isoformat()
+        _today = (iso, datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time.min).timestamp())
+    return iso
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+async def read_json(request):
+    return orjson.loads(await request.body())
+
+def rpc_envelope(msg_id, result: bytes) -> bytes:
+    """Sobre JSON-RPC alrededor de un "result" ya serializado."""
+    return b'{"jsonrpc":"2.0","id":' + orjson.dumps(msg_id) + b',"result":' + result + b'}'
+
+def rpc_text(text: str) -> bytes:
+    """Result de tools/call con un solo bloque de texto, armado sin dicts intermedios."""
+    return b'{"content":[{"type":"text","text":' + orjson.dumps(text) + b'}]}'
+
+async def rpc_unknown(body: dict) -> bytes:
+    return b"{}"
+
+def build_rpc_methods(name: str, version: str, tools: list, execute_tool) -> tuple:
+    """
+    Arma la tabla de metodos MCP de un servidor. Los handlers devuelven el
+    "result" ya serializado; initialize y tools/list se codifican una sola vez.
+    Devuelve (RPC_METHODS, bytes de {"tools": tools}) para reusar en /tools.
+    """
+    tools_bytes = orjson.dumps({"tools": tools})
+    initialize_bytes = orjson.dumps({
+        "protocolVersion": PROTOCOL_VERSION,
+        "capabilities": {"tools": {}},
+        "serverInfo": {"name": name, "version": version}
+    })
+
+    async def rpc_initialize(body: dict) -> bytes:
+        return initialize_bytes
+
+    async def rpc_tools_list(body: dict) -> bytes:
+        return tools_bytes
+
+    async def rpc_tools_call(body: dict) -> bytes:
+        params = body.get("params", {})
+        result = await execute_tool(params.get("name", ""), params.get("arguments", {}))
+        return rpc_text(result)
+
+    methods = {
+        "initialize": rpc_initialize,
+        "tools/list": rpc_tools_list,
+        "tools/call": rpc_tools_call,
+    }
+    return methods, tools_bytes
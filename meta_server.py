@@ -5,14 +5,19 @@ Conecta la IA con tus campañas publicitarias.
 
 import os
 import json
+import time
 import httpx
+import orjson
 import asyncio
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from starlette.applications import Starlette
 from starlette.routing import Route
-from starlette.responses import Response, JSONResponse
+from starlette.responses import Response
+from starlette.background import BackgroundTask
 from sse_starlette.sse import EventSourceResponse
 import uvicorn
+from mcp_transport import ORJSONResponse, read_json, rpc_envelope, rpc_unknown, build_rpc_methods, today_iso
 
 load_dotenv()
 
@@ -21,12 +26,32 @@ META_AD_ACCOUNT_ID = os.getenv("META_AD_ACCOUNT_ID", "")
 
 sessions = {}
 
+# Cliente HTTP compartido con la Graph API (keep-alive + HTTP/2), se crea en el lifespan
+_client: httpx.AsyncClient = None
+
+# action_type que Meta usa para compras
+PURCHASE_TYPES = frozenset(("purchase", "omni_purchase"))
+
+# Insights de HOY a nivel campaña: una sola llamada a la Graph API alimenta
+# get_ad_spend_today (suma) y get_campaign_performance (desglose).
+TODAY_INSIGHTS_TTL = 30
+_today_insights_cache = (0.0, None)
+# El alcance no se puede sumar por campaña (duplica personas): se pide aparte a nivel cuenta
+_today_reach_cache = (0.0, None)
+
 def get_account_id():
     account_id = META_AD_ACCOUNT_ID
     if not account_id.startswith("act_"):
         account_id = f"act_{account_id}"
     return account_id
 
+# Las variables de entorno no cambian en caliente: cuenta y URLs se arman una vez
+AD_ACCOUNT_ID = get_account_id()
+ACCOUNT_URL = f"https://graph.facebook.com/v19.0/{AD_ACCOUNT_ID}"
+INSIGHTS_URL = f"{ACCOUNT_URL}/insights"
+
+ACCOUNT_STATUS = {1: "Activa", 2: "Deshabilitada", 3: "Sin configurar", 7: "Pendiente"}
+
 TOOLS = [
     {
         "name": "get_ad_spend_today",
@@ -63,48 +88,86 @@ TOOLS = [
     }
 ]
 
-async def get_ad_spend_today(args: dict) -> str:
-    import datetime
-    today = datetime.date.today().isoformat()
+async def fetch_today_insights() -> dict:
+    """Insights de hoy por campaña, cacheados TODAY_INSIGHTS_TTL segundos."""
+    global _today_insights_cache
+    
+    now = time.monotonic()
+    cached_at, cached = _today_insights_cache
+    if cached is not None and now - cached_at < TODAY_INSIGHTS_TTL:
+        return cached
+    
+    params = {
+        "access_token": META_ACCESS_TOKEN,
+        "date_preset": "today",
+        "fields": "campaign_name,spend,impressions,clicks,actions",
+        "level": "campaign",
+        "limit": 500
+    }
+    
+    response = await _client.get(INSIGHTS_URL, params=params)
+    data = orjson.loads(response.content)
+
+    # Los errores no se cachean para que el siguiente intento vuelva a consultar
+    if "error" not in data:
+        _today_insights_cache = (now, data)
+    return data
+
+async def fetch_today_reach():
+    """Alcance de hoy a nivel cuenta (personas unicas), o None si Meta no lo devuelve."""
+    global _today_reach_cache
     
-    account_id = get_account_id()
-    url = f"https://graph.facebook.com/v19.0/{account_id}/insights"
+    now = time.monotonic()
+    cached_at, cached = _today_reach_cache
+    if cached is not None and now - cached_at < TODAY_INSIGHTS_TTL:
+        return cached
     
     params = {
         "access_token": META_ACCESS_TOKEN,
         "date_preset": "today",
-        "fields": "spend,impressions,clicks,cpc,ctr,reach",
+        "fields": "reach",
         "level": "account"
     }
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            data = response.json()
-            
-            if "error" in data:
-                return f"Error de Meta: {data['error'].get('message', 'Error desconocido')}"
-            
-            if not data.get("data"):
-                return f"📊 META ADS HOY ({today}):\n💸 Gasto: $0.00\n👀 Impresiones: 0\n👆 Clics: 0\n\n(No hay datos o Meta no ha actualizado todavia)"
-            
-            stats = data["data"][0]
-            spend = float(stats.get('spend', 0))
-            impressions = int(stats.get('impressions', 0))
-            clicks = int(stats.get('clicks', 0))
-            cpc = float(stats.get('cpc', 0))
-            ctr = float(stats.get('ctr', 0))
-            reach = int(stats.get('reach', 0))
-            
-            return f"""📊 META ADS HOY ({today}):
+    response = await _client.get(INSIGHTS_URL, params=params)
+    rows = orjson.loads(response.content).get("data")
+    if not rows:
+        return None
+    reach = int(rows[0].get("reach", 0))
+    _today_reach_cache = (now, reach)
+    return reach
+
+async def get_ad_spend_today(args: dict) -> str:
+    today = today_iso()
+    
+    try:
+        data, reach = await asyncio.gather(fetch_today_insights(), fetch_today_reach())
+        
+        if "error" in data:
+            return f"Error de Meta: {data['error'].get('message', 'Error desconocido')}"
+        
+        campaigns = data.get("data")
+        if not campaigns:
+            return f"📊 META ADS HOY ({today}):\n💸 Gasto: $0.00\n👀 Impresiones: 0\n👆 Clics: 0\n\n(No hay datos o Meta no ha actualizado todavia)"
+        
+        # Totales de cuenta = suma de campañas; CPC y CTR se derivan de los totales.
+        # El alcance viene de la consulta a nivel cuenta, no de esta suma.
+        spend = sum(float(c.get('spend', 0)) for c in campaigns)
+        impressions = sum(int(c.get('impressions', 0)) for c in campaigns)
+        clicks = sum(int(c.get('clicks', 0)) for c in campaigns)
+        cpc = spend / clicks if clicks else 0
+        ctr = clicks / impressions * 100 if impressions else 0
+        reach_text = f"{reach:,}" if reach is not None else "N/D"
+        
+        return f"""📊 META ADS HOY ({today}):
 💸 Gasto: ${spend:,.2f}
 👀 Impresiones: {impressions:,}
 👆 Clics: {clicks:,}
 💰 CPC: ${cpc:.2f}
 📈 CTR: {ctr:.2f}%
-🎯 Alcance: {reach:,}"""
-        except Exception as e:
-            return f"Error de conexion: {str(e)}"
+🎯 Alcance: {reach_text}"""
+    except Exception as e:
+        return f"Error de conexion: {str(e)}"
 
 async def get_ad_spend_by_period(args: dict) -> str:
     # DEBUG
@@ -120,9 +183,6 @@ async def get_ad_spend_by_period(args: dict) -> str:
     
     print(f"📊 start_date: {start_date}, end_date: {end_date}, period: {period}")
     
-    account_id = get_account_id()
-    url = f"https://graph.facebook.com/v19.0/{account_id}/insights"
-    
     params = {
         "access_token": META_ACCESS_TOKEN,
         "fields": "spend,impressions,clicks,cpc,ctr,reach,actions",
@@ -138,8 +198,7 @@ async def get_ad_spend_by_period(args: dict) -> str:
             label = f"{start_date} a {end_date}"
     elif start_date:
         # Solo fecha inicio, hasta hoy
-        import datetime
-        today = datetime.date.today().isoformat()
+        today = today_iso()
         params["time_range"] = json.dumps({"since": start_date, "until": today})
         label = f"desde {start_date}"
     else:
@@ -158,115 +217,101 @@ async def get_ad_spend_by_period(args: dict) -> str:
     
     print(f"📊 Query Meta: {params}")
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            data = response.json()
-            
-            print(f"📊 Meta response: {data}")
-            
-            if "error" in data:
-                return f"Error de Meta: {data['error'].get('message', 'Error desconocido')}"
-            
-            if not data.get("data"):
-                return f"📊 META ADS ({label}):\n💸 Sin datos para este periodo"
-            
-            stats = data["data"][0]
-            spend = float(stats.get('spend', 0))
-            impressions = int(stats.get('impressions', 0))
-            clicks = int(stats.get('clicks', 0))
-            
-            # Buscar conversiones
-            purchases = 0
-            leads = 0
-            if 'actions' in stats:
-                for action in stats['actions']:
-                    if action['action_type'] in ['purchase', 'omni_purchase']:
-                        purchases = int(action['value'])
-                    if action['action_type'] == 'lead':
-                        leads = int(action['value'])
-            
-            result = f"""📊 META ADS ({label}):
+    try:
+        response = await _client.get(INSIGHTS_URL, params=params)
+        data = orjson.loads(response.content)
+        
+        print(f"📊 Meta response: {data}")
+        
+        if "error" in data:
+            return f"Error de Meta: {data['error'].get('message', 'Error desconocido')}"
+        
+        if not data.get("data"):
+            return f"📊 META ADS ({label}):\n💸 Sin datos para este periodo"
+        
+        stats = data["data"][0]
+        spend = float(stats.get('spend', 0))
+        impressions = int(stats.get('impressions', 0))
+        clicks = int(stats.get('clicks', 0))
+        
+        # Buscar conversiones
+        purchases = 0
+        leads = 0
+        if 'actions' in stats:
+            for action in stats['actions']:
+                if action['action_type'] in ['purchase', 'omni_purchase']:
+                    purchases = int(action['value'])
+                if action['action_type'] == 'lead':
+                    leads = int(action['value'])
+        
+        result = f"""📊 META ADS ({label}):
 💸 Gasto: ${spend:,.2f}
 👀 Impresiones: {impressions:,}
 👆 Clics: {clicks:,}"""
-            
-            if purchases > 0:
-                cpa = spend / purchases
-                result += f"\n🛒 Compras: {purchases}\n💰 CPA: ${cpa:.2f}"
-            
-            if leads > 0:
-                cpl = spend / leads
-                result += f"\n📝 Leads: {leads}\n💰 CPL: ${cpl:.2f}"
-            
-            # Agregar datos JSON para el dashboard
-            result_json = {
-                "period": label,
-                "spend": spend,
-                "impressions": impressions,
-                "clicks": clicks,
-                "purchases": purchases,
-                "leads": leads,
-                "cpa": spend / purchases if purchases > 0 else None
-            }
-            
-            result += f"\n\n---JSON_DATA---\n{json.dumps(result_json)}"
-            
-            return result
-        except Exception as e:
-            return f"Error: {str(e)}"
+        
+        if purchases > 0:
+            cpa = spend / purchases
+            result += f"\n🛒 Compras: {purchases}\n💰 CPA: ${cpa:.2f}"
+        
+        if leads > 0:
+            cpl = spend / leads
+            result += f"\n📝 Leads: {leads}\n💰 CPL: ${cpl:.2f}"
+        
+        # Agregar datos JSON para el dashboard
+        result_json = {
+            "period": label,
+            "spend": spend,
+            "impressions": impressions,
+            "clicks": clicks,
+            "purchases": purchases,
+            "leads": leads,
+            "cpa": spend / purchases if purchases > 0 else None
+        }
+        
+        result += f"\n\n---JSON_DATA---\n{json.dumps(result_json)}"
+        
+        return result
+    except Exception as e:
+        return f"Error: {str(e)}"
 
 async def get_campaign_performance(args: dict) -> str:
-    account_id = get_account_id()
-    url = f"https://graph.facebook.com/v19.0/{account_id}/insights"
-    
-    params = {
-        "access_token": META_ACCESS_TOKEN,
-        "date_preset": "today",
-        "fields": "campaign_name,spend,impressions,clicks,cpc,actions",
-        "level": "campaign",
-        "limit": 50
-    }
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            data = response.json()
-            
-            if "error" in data:
-                return f"Error de Meta: {data['error'].get('message', 'Error desconocido')}"
-            
-            if not data.get("data"):
-                return "📊 No hay campañas activas con gasto hoy."
+    try:
+        data = await fetch_today_insights()
+        
+        if "error" in data:
+            return f"Error de Meta: {data['error'].get('message', 'Error desconocido')}"
+        
+        if not data.get("data"):
+            return "📊 No hay campañas activas con gasto hoy."
+        
+        parts = ["🔥 RENDIMIENTO POR CAMPAÑA (HOY):\n\n"]
+        
+        for campaign in data["data"]:
+            spend = float(campaign.get('spend', 0))
+            clicks = int(campaign.get('clicks', 0))
             
-            result = "🔥 RENDIMIENTO POR CAMPAÑA (HOY):\n\n"
+            actions = {
+                a['action_type']: int(a['value'])
+                for a in campaign.get('actions', ())
+                if a['action_type'] in PURCHASE_TYPES
+            }
+            purchases = actions.get('omni_purchase') or actions.get('purchase') or 0
             
-            for campaign in data["data"]:
-                spend = float(campaign.get('spend', 0))
-                clicks = int(campaign.get('clicks', 0))
-                
-                purchases = 0
-                if 'actions' in campaign:
-                    for action in campaign['actions']:
-                        if action['action_type'] in ['purchase', 'omni_purchase']:
-                            purchases = int(action['value'])
-                
-                cpa = f"${spend/purchases:.2f}" if purchases > 0 else "N/A"
-                
-                result += f"📌 {campaign['campaign_name']}\n"
-                result += f"   💸 Gasto: ${spend:.2f}\n"
-                result += f"   👆 Clics: {clicks}\n"
-                result += f"   🛒 Compras: {purchases}\n"
-                result += f"   💰 CPA: {cpa}\n\n"
+            cpa = f"${spend/purchases:.2f}" if purchases > 0 else "N/A"
             
-            return result
-        except Exception as e:
-            return f"Error: {str(e)}"
+            parts.append(
+                f"📌 {campaign['campaign_name']}\n"
+                f"   💸 Gasto: ${spend:.2f}\n"
+                f"   👆 Clics: {clicks}\n"
+                f"   🛒 Compras: {purchases}\n"
+                f"   💰 CPA: {cpa}\n\n"
+            )
+        
+        return "".join(parts)
+    except Exception as e:
+        return f"Error: {str(e)}"
 
 async def get_adset_performance(args: dict) -> str:
-    account_id = get_account_id()
-    url = f"https://graph.facebook.com/v19.0/{account_id}/insights"
-    
     params = {
         "access_token": META_ACCESS_TOKEN,
         "date_preset": "today",
@@ -275,62 +320,56 @@ async def get_adset_performance(args: dict) -> str:
         "limit": 50
     }
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            data = response.json()
-            
-            if "error" in data:
-                return f"Error de Meta: {data['error'].get('message', 'Error desconocido')}"
-            
-            if not data.get("data"):
-                return "📊 No hay adsets activos con gasto hoy."
+    try:
+        response = await _client.get(INSIGHTS_URL, params=params)
+        data = orjson.loads(response.content)
+        
+        if "error" in data:
+            return f"Error de Meta: {data['error'].get('message', 'Error desconocido')}"
+        
+        if not data.get("data"):
+            return "📊 No hay adsets activos con gasto hoy."
+        
+        result = "📊 RENDIMIENTO POR ADSET (HOY):\n\n"
+        
+        for adset in data["data"]:
+            spend = float(adset.get('spend', 0))
             
-            result = "📊 RENDIMIENTO POR ADSET (HOY):\n\n"
-            
-            for adset in data["data"]:
-                spend = float(adset.get('spend', 0))
-                
-                result += f"📌 {adset.get('adset_name', 'Sin nombre')}\n"
-                result += f"   📢 Campaña: {adset.get('campaign_name', 'N/A')}\n"
-                result += f"   💸 Gasto: ${spend:.2f}\n"
-                result += f"   👀 Impresiones: {adset.get('impressions', 0)}\n\n"
-            
-            return result
-        except Exception as e:
-            return f"Error: {str(e)}"
+            result += f"📌 {adset.get('adset_name', 'Sin nombre')}\n"
+            result += f"   📢 Campaña: {adset.get('campaign_name', 'N/A')}\n"
+            result += f"   💸 Gasto: ${spend:.2f}\n"
+            result += f"   👀 Impresiones: {adset.get('impressions', 0)}\n\n"
+        
+        return result
+    except Exception as e:
+        return f"Error: {str(e)}"
 
 async def get_ad_account_info(args: dict) -> str:
-    account_id = get_account_id()
-    url = f"https://graph.facebook.com/v19.0/{account_id}"
-    
     params = {
         "access_token": META_ACCESS_TOKEN,
         "fields": "name,account_status,currency,timezone_name,amount_spent,balance,spend_cap"
     }
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            data = response.json()
-            
-            if "error" in data:
-                return f"Error de Meta: {data['error'].get('message', 'Error desconocido')}"
-            
-            status_map = {1: "Activa", 2: "Deshabilitada", 3: "Sin configurar", 7: "Pendiente"}
-            status = status_map.get(data.get('account_status', 0), "Desconocido")
-            
-            amount_spent = float(data.get('amount_spent', 0)) / 100  # Meta lo devuelve en centavos
-            
-            return f"""📱 CUENTA DE META ADS:
+    try:
+        response = await _client.get(ACCOUNT_URL, params=params)
+        data = orjson.loads(response.content)
+        
+        if "error" in data:
+            return f"Error de Meta: {data['error'].get('message', 'Error desconocido')}"
+        
+        status = ACCOUNT_STATUS.get(data.get('account_status', 0), "Desconocido")
+        
+        amount_spent = float(data.get('amount_spent', 0)) / 100  # Meta lo devuelve en centavos
+        
+        return f"""📱 CUENTA DE META ADS:
 📛 Nombre: {data.get('name', 'N/A')}
 📊 Estado: {status}
 💰 Moneda: {data.get('currency', 'N/A')}
 🌍 Zona horaria: {data.get('timezone_name', 'N/A')}
 💸 Gastado total: ${amount_spent:,.2f}
-🆔 ID: {account_id}"""
-        except Exception as e:
-            return f"Error: {str(e)}"
+🆔 ID: {AD_ACCOUNT_ID}"""
+    except Exception as e:
+        return f"Error: {str(e)}"
 
 # ========== DISPATCHER ==========
 
@@ -351,17 +390,21 @@ async def execute_tool(name: str, args: dict) -> str:
             return f"Error: {str(e)}"
     return f"Herramienta {name} no encontrada"
 
+# ========== JSON-RPC (MCP) ==========
+
+RPC_METHODS, _TOOLS_BYTES = build_rpc_methods("meta-mcp", "1.0.0", TOOLS, execute_tool)
+
 # ========== ENDPOINTS ==========
 
 async def http_tools(request):
-    return JSONResponse({"tools": TOOLS})
+    return Response(_TOOLS_BYTES, media_type="application/json")
 
 async def http_call_tool(request):
-    body = await request.json()
+    body = await read_json(request)
     name = body.get("name", "")
     args = body.get("arguments", {})
     result = await execute_tool(name, args)
-    return JSONResponse({"result": result})
+    return ORJSONResponse({"result": result})
 
 async def sse_endpoint(request):
     queue = asyncio.Queue()
@@ -372,38 +415,44 @@ async def sse_endpoint(request):
             yield {"event": "endpoint", "data": f"/messages/{session_id}"}
             while True:
                 data = await queue.get()
-                yield {"event": "message", "data": json.dumps(data)}
+                yield {"event": "message", "data": data.decode()}
         except asyncio.CancelledError:
             pass
         finally:
             sessions.pop(session_id, None)
     return EventSourceResponse(event_generator())
 
+async def dispatch_rpc(session_id: str, body: dict):
+    msg_id = body.get("id")
+    handler = RPC_METHODS.get(body.get("method", ""), rpc_unknown)
+    result = await handler(body)
+    queue = sessions.get(session_id)
+    if msg_id and queue is not None:
+        await queue.put(rpc_envelope(msg_id, result))
+
 async def messages_endpoint(request):
     session_id = request.path_params["session_id"]
     if session_id not in sessions:
         return Response("Session not found", status_code=404)
-    body = await request.json()
-    method = body.get("method", "")
-    msg_id = body.get("id")
-    if method == "initialize":
-        response = {"jsonrpc": "2.0", "id": msg_id, "result": {"protocolVersion": "2024-11-05", "capabilities": {"tools": {}}, "serverInfo": {"name": "meta-mcp", "version": "1.0.0"}}}
-    elif method == "tools/list":
-        response = {"jsonrpc": "2.0", "id": msg_id, "result": {"tools": TOOLS}}
-    elif method == "tools/call":
-        params = body.get("params", {})
-        result = await execute_tool(params.get("name", ""), params.get("arguments", {}))
-        response = {"jsonrpc": "2.0", "id": msg_id, "result": {"content": [{"type": "text", "text": result}]}}
-    else:
-        response = {"jsonrpc": "2.0", "id": msg_id, "result": {}}
-    if response and msg_id:
-        await sessions[session_id].put(response)
-    return Response("OK")
+    body = await read_json(request)
+    # ACK inmediato: la respuesta viaja por el SSE cuando termina la herramienta
+    return Response("OK", background=BackgroundTask(dispatch_rpc, session_id, body))
 
 async def health(request):
     return Response("OK")
 
-app = Starlette(routes=[
+@asynccontextmanager
+async def lifespan(app):
+    global _client
+    _client = httpx.AsyncClient(
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=300.0),
+        http2=True
+    )
+    yield
+    await _client.aclose()
+
+app = Starlette(lifespan=lifespan, routes=[
     Route("/", health),
     Route("/health", health),
     Route("/tools", http_tools),
@@ -414,4 +463,15 @@ app = Starlette(routes=[
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 3000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # Sesiones SSE en memoria del proceso: un worker salvo que haya afinidad de sesion
+    uvicorn.run(
+        "meta_server:app",
+        host="0.0.0.0",
+        port=port,
+        workers=int(os.getenv("UVICORN_WORKERS", 1)),
+        loop="uvloop",
+        http="httptools",
+        # Sin access log: cada POST a /messages y cada keepalive SSE escribia una linea
+        log_level="warning",
+        access_log=False
+    )
\ No newline at end of file
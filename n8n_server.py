@@ -11,8 +11,10 @@ from dotenv import load_dotenv
 from starlette.applications import Starlette
 from starlette.routing import Route
 from starlette.responses import Response, JSONResponse
+from starlette.background import BackgroundTask
 from sse_starlette.sse import EventSourceResponse
 import uvicorn
+from mcp_transport import ORJSONResponse, read_json, rpc_envelope, rpc_unknown, build_rpc_methods
 
 load_dotenv()
 
@@ -212,17 +214,23 @@ async def execute_tool(name: str, args: dict) -> str:
             return f"Error ejecutando {name}: {str(e)}"
     return f"Herramienta '{name}' no encontrada"
 
+# ==============================================================================
+# JSON-RPC (MCP)
+# ==============================================================================
+
+RPC_METHODS, _TOOLS_BYTES = build_rpc_methods("n8n-mcp", "1.0.0", TOOLS, execute_tool)
+
 # ==============================================================================
 # ENDPOINTS HTTP
 # ==============================================================================
 
 async def http_tools(request):
-    return JSONResponse({"tools": TOOLS})
+    return Response(_TOOLS_BYTES, media_type="application/json")
 
 async def http_call_tool(request):
-    body = await request.json()
+    body = await read_json(request)
     result = await execute_tool(body.get("name", ""), body.get("arguments", {}))
-    return JSONResponse({"result": result})
+    return ORJSONResponse({"result": result})
 
 async def sse_endpoint(request):
     queue = asyncio.Queue()
@@ -233,33 +241,28 @@ async def sse_endpoint(request):
             yield {"event": "endpoint", "data": f"/messages/{session_id}"}
             while True:
                 data = await queue.get()
-                yield {"event": "message", "data": json.dumps(data)}
+                yield {"event": "message", "data": data.decode()}
         except asyncio.CancelledError:
             pass
         finally:
             sessions.pop(session_id, None)
     return EventSourceResponse(gen())
 
+async def dispatch_rpc(session_id: str, body: dict):
+    msg_id = body.get("id")
+    handler = RPC_METHODS.get(body.get("method", ""), rpc_unknown)
+    result = await handler(body)
+    queue = sessions.get(session_id)
+    if msg_id and queue is not None:
+        await queue.put(rpc_envelope(msg_id, result))
+
 async def messages_endpoint(request):
     session_id = request.path_params["session_id"]
     if session_id not in sessions:
         return Response("Not found", status_code=404)
-    body = await request.json()
-    method = body.get("method", "")
-    msg_id = body.get("id")
-    if method == "initialize":
-        resp = {"jsonrpc": "2.0", "id": msg_id, "result": {"protocolVersion": "2024-11-05", "capabilities": {"tools": {}}, "serverInfo": {"name": "n8n-mcp", "version": "1.0.0"}}}
-    elif method == "tools/list":
-        resp = {"jsonrpc": "2.0", "id": msg_id, "result": {"tools": TOOLS}}
-    elif method == "tools/call":
-        params = body.get("params", {})
-        result = await execute_tool(params.get("name", ""), params.get("arguments", {}))
-        resp = {"jsonrpc": "2.0", "id": msg_id, "result": {"content": [{"type": "text", "text": result}]}}
-    else:
-        resp = {"jsonrpc": "2.0", "id": msg_id, "result": {}}
-    if resp and msg_id:
-        await sessions[session_id].put(resp)
-    return Response("OK")
+    body = await read_json(request)
+    # ACK inmediato: la respuesta viaja por el SSE cuando termina la herramienta
+    return Response("OK", background=BackgroundTask(dispatch_rpc, session_id, body))
 
 async def health(request):
     return JSONResponse({
@@ -287,4 +290,15 @@ if __name__ == "__main__":
     print(f"🚀 N8N MCP Server v1.0")
     print(f"🔗 N8N URL: {N8N_BASE_URL}")
     print(f"📊 Webhook Gráfico: {N8N_WEBHOOK_GRAFICO}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Sesiones SSE en memoria del proceso: un worker salvo que haya afinidad de sesion
+    uvicorn.run(
+        "n8n_server:app",
+        host="0.0.0.0",
+        port=port,
+        workers=int(os.getenv("UVICORN_WORKERS", 1)),
+        loop="uvloop",
+        http="httptools",
+        # Sin access log: cada POST a /messages y cada keepalive SSE escribia una linea
+        log_level="warning",
+        access_log=False
+    )
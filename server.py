@@ -6,10 +6,12 @@ CON PARSEO MEJORADO para JSON estructurado de Dropi
 import logging
 import asyncio
 import json
+import math
 import re
+import orjson
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request, HTTPException, Form, BackgroundTasks
+from fastapi import FastAPI, Request, HTTPException, Form
 from fastapi.responses import Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from twilio.twiml.messaging_response import MessagingResponse
@@ -31,6 +33,14 @@ logger = logging.getLogger(__name__)
 # LIFECYCLE DEL SERVIDOR
 # =============================================================================
 
+# Cola persistente de mensajes: el webhook solo encola y responde a Twilio,
+# un pool fijo de workers procesa los mensajes (concurrencia acotada).
+MESSAGE_WORKERS = 4
+_msg_queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+# Al apagar se espera a que la cola se vacie: Twilio ya recibio su 200 y no reintenta
+SHUTDOWN_DRAIN_TIMEOUT = 25
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("🚀 Iniciando Super Agente de IA v2.1...")
@@ -41,9 +51,19 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.warning(f"⚠️ Error inicializando MCP: {e}")
     
+    workers = [asyncio.create_task(_message_worker()) for _ in range(MESSAGE_WORKERS)]
+    logger.info(f"✅ {MESSAGE_WORKERS} workers de mensajes activos")
+    
     yield
     
     logger.info("🛑 Cerrando conexiones...")
+    try:
+        await asyncio.wait_for(_msg_queue.join(), timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ Quedaron {_msg_queue.qsize()} mensajes sin procesar al cerrar")
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
     await mcp_client.close()
     logger.info("✅ Servidor cerrado correctamente")
 
@@ -81,6 +101,12 @@ if settings.twilio_account_sid and settings.twilio_auth_token:
     except Exception as e:
         logger.error(f"❌ Error inicializando Twilio: {e}")
 
+# El validador solo depende del auth token: se crea una vez al arrancar
+_twilio_validator = RequestValidator(settings.twilio_auth_token)
+
+# La respuesta TwiML del webhook siempre es el mismo <Response/> vacío
+_EMPTY_TWIML = str(MessagingResponse()).encode("utf-8")
+
 
 # =============================================================================
 # FUNCIONES DE PARSEO - MEJORADAS
@@ -220,46 +246,120 @@ def parse_mcp_result(result):
     if result is None:
         return None
     
+    # MCP devuelve dict/str nativos: basta comparar el tipo exacto
+    result_type = type(result)
+    
     # Si ya es un dict, retornarlo
-    if isinstance(result, dict):
+    if result_type is dict:
         return result
     
     # Si es un string
-    if isinstance(result, str):
+    if result_type is str:
         # PRIORIDAD 1: Buscar JSON estructurado
         json_data = extract_json_from_response(result)
         if json_data:
             logger.info(f"✅ JSON estructurado extraído: {json_data}")
             return json_data
         
-        # PRIORIDAD 2: Intentar parsear como JSON puro
-        try:
-            return json.loads(result)
-        except json.JSONDecodeError:
-            pass
-        
-        # PRIORIDAD 3: Parsear texto formateado
-        parsed = parse_formatted_text(result)
-        if parsed:
-            logger.info(f"📝 Parseado texto formateado: {parsed}")
-            return parsed
-        
-        # PRIORIDAD 4: Retornar como texto
-        logger.warning(f"⚠️ No se pudo parsear: {result[:100]}")
-        return {"raw_text": result}
+        return parse_mcp_text(result)
     
     return result
 
 
-def validate_twilio_request(request: Request, form_data: dict) -> bool:
+def parse_mcp_text(result: str):
+    """Prioridades 2-4 de parse_mcp_result para texto sin JSON_DATA utilizable."""
+    # PRIORIDAD 2: Intentar parsear como JSON puro
+    try:
+        return json.loads(result)
+    except json.JSONDecodeError:
+        pass
+    
+    # PRIORIDAD 3: Parsear texto formateado
+    parsed = parse_formatted_text(result)
+    if parsed:
+        logger.info(f"📝 Parseado texto formateado: {parsed}")
+        return parsed
+    
+    # PRIORIDAD 4: Retornar como texto
+    logger.warning(f"⚠️ No se pudo parsear: {result[:100]}")
+    return {"raw_text": result}
+
+
+def parse_mcp_result_json_marker(result):
+    """
+    Atajo de parse_mcp_result para herramientas que siempre devuelven
+    texto con ---JSON_DATA--- (Dropi v6, Meta por periodo).
+    Si el marcador no aparece, cae al parseo completo; si el JSON no parsea,
+    pasa directo a los fallbacks sin marcador.
+    """
+    if type(result) is str:
+        _, sep, json_part = result.partition("---JSON_DATA---")
+        if sep:
+            try:
+                return orjson.loads(json_part)
+            except orjson.JSONDecodeError as e:
+                logger.warning(f"⚠️ Error parseando JSON_DATA: {e}")
+                return parse_mcp_text(result)
+    
+    return parse_mcp_result(result)
+
+
+# Plantilla de la respuesta del dashboard: la estructura externa es fija,
+# solo se serializan los valores y los dicts de cada fuente.
+_DASHBOARD_TMPL = (
+    b'{"success":true,'
+    b'"period":{"start":%b,"end":%b,"label":%b},'
+    b'"master":{"gastosAds":%.2f,"ingresosDropi":%.2f,"egresosDropi":%.2f,'
+    b'"profitNeto":%.2f,"roi":%.2f},'
+    b'"dropi":%b,"meta":%b,"tiktok":%b,"shopify":%b}'
+)
+
+
+# Specs de ingesta para el dashboard: (sección, clave destino, clave origen, conversión, default)
+# Una sección None escribe directamente en el dict destino.
+_DROPI_WALLET_SPEC = (
+    (None, "saldo", "balance", float, 0),
+)
+_DROPI_HISTORY_SPEC = (
+    (None, "ingresos_totales", "total_income", float, 0),
+    (None, "egresos_totales", "total_expenses", float, 0),
+)
+_DROPI_ORDERS_SPEC = (
+    ("pedidos", "total", "total_orders", int, 0),
+    ("pedidos", "monto", "total_amount", float, 0),
+    ("entregas", "total", "delivered", int, 0),
+    ("entregas", "monto", "delivered_amount", float, 0),
+    ("devoluciones", "total", "returned", int, 0),
+    ("devoluciones", "monto", "returned_amount", float, 0),
+)
+_META_SPEND_SPEC = (
+    (None, "gasto", "spend", float, 0),
+    (None, "cpm", "cpm", float, 0),
+    (None, "ctr", "ctr", float, 0),
+)
+_SHOPIFY_SALES_SPEC = (
+    (None, "pedidos", "total_orders", int, 0),
+)
+
+
+def _ingest(src: dict, dst: dict, spec) -> None:
+    """Copia los campos de un resultado MCP al dict del dashboard según el spec."""
+    for section, dkey, skey, conv, default in spec:
+        target = dst[section] if section else dst
+        target[dkey] = conv(src.get(skey, default))
+
+
+async def validate_twilio_request(request: Request, form_data: dict) -> bool:
     if settings.debug:
         return True
     
-    validator = RequestValidator(settings.twilio_auth_token)
-    url = str(request.url)
     signature = request.headers.get("X-Twilio-Signature", "")
+    if not signature:
+        return False
     
-    return validator.validate(url, form_data, signature)
+    # El HMAC-SHA1 es trabajo de CPU: se ejecuta fuera del event loop
+    url = str(request.url)
+    return await asyncio.to_thread(_twilio_validator.validate, url, form_data, signature)
 
 
 async def send_whatsapp_message(to: str, body: str, from_number: str = None):
@@ -337,6 +437,15 @@ async def process_message_background(user_id: str, message: str, reply_to: str):
         )
 
 
+async def _message_worker():
+    while True:
+        user_id, message, reply_to = await _msg_queue.get()
+        try:
+            await process_message_background(user_id, message, reply_to)
+        finally:
+            _msg_queue.task_done()
+
+
 # =============================================================================
 # ENDPOINTS
 # =============================================================================
@@ -360,12 +469,10 @@ async def root():
 @app.get("/health")
 async def health_check():
     mcp_status = "connected" if mcp_client._initialized else "disconnected"
-    tools_count = sum(len(tools) for tools in mcp_client.tools_cache.values())
-    
     return {
         "status": "healthy",
         "mcp_client": mcp_status,
-        "tools_available": tools_count,
+        "tools_available": mcp_client.total_tools,
         "servers_connected": list(mcp_client.sessions.keys()),
         "twilio_client": "ready" if twilio_client else "not configured"
     }
@@ -374,7 +481,6 @@ async def health_check():
 @app.post("/webhook/whatsapp")
 async def whatsapp_webhook(
     request: Request,
-    background_tasks: BackgroundTasks,
     From: str = Form(...),
     Body: str = Form(...),
     To: str = Form(None),
@@ -387,24 +493,26 @@ async def whatsapp_webhook(
         "MessageSid": MessageSid or ""
     }
     
-    if not validate_twilio_request(request, form_data):
+    if not await validate_twilio_request(request, form_data):
         logger.warning(f"Request inválida rechazada desde {From}")
         raise HTTPException(status_code=403, detail="Invalid Twilio signature")
     
     user_id = From.replace("whatsapp:", "")
     logger.info(f"📩 Mensaje de {user_id}: {Body[:50]}...")
     
-    background_tasks.add_task(
-        process_message_background,
-        user_id=user_id,
-        message=Body,
-        reply_to=From
-    )
-    
-    twiml_response = MessagingResponse()
+    try:
+        _msg_queue.put_nowait((user_id, Body, From))
+    except asyncio.QueueFull:
+        logger.warning(f"⚠️ Cola de mensajes llena, rechazando mensaje de {user_id}")
+        busy_response = MessagingResponse()
+        busy_response.message("Estoy procesando muchos mensajes en este momento. Por favor intenta de nuevo en unos minutos.")
+        return Response(
+            content=str(busy_response),
+            media_type="application/xml"
+        )
     
     return Response(
-        content=str(twiml_response),
+        content=_EMPTY_TWIML,
         media_type="application/xml"
     )
 
@@ -450,7 +558,7 @@ async def get_dashboard_data(request: Request):
             wallet_result = parse_mcp_result(wallet_raw)
             
             if wallet_result and isinstance(wallet_result, dict):
-                dropi_data["saldo"] = float(wallet_result.get("balance", 0))
+                _ingest(wallet_result, dropi_data, _DROPI_WALLET_SPEC)
                 logger.info(f"💰 Saldo Dropi: Q{dropi_data['saldo']:,.2f}")
             
             # =========================================================
@@ -469,12 +577,11 @@ async def get_dashboard_data(request: Request):
                 days = 7
             
             history_raw = await mcp_client.call_tool("dropi", "get_dropi_wallet_history", {"days": days})
-            history_result = parse_mcp_result(history_raw)
+            history_result = parse_mcp_result_json_marker(history_raw)
             
             if history_result and isinstance(history_result, dict):
                 # Ahora viene JSON estructurado!
-                dropi_data["ingresos_totales"] = float(history_result.get("total_income", 0))
-                dropi_data["egresos_totales"] = float(history_result.get("total_expenses", 0))
+                _ingest(history_result, dropi_data, _DROPI_HISTORY_SPEC)
                 
                 logger.info(f"💵 Ingresos: Q{dropi_data['ingresos_totales']:,.2f}")
                 logger.info(f"💸 Egresos: Q{dropi_data['egresos_totales']:,.2f}")
@@ -483,7 +590,7 @@ async def get_dashboard_data(request: Request):
             # ORDERS
             # =========================================================
             orders_raw = await mcp_client.call_tool("dropi", "get_dropi_orders", {"days": days, "limit": 100})
-            orders_result = parse_mcp_result(orders_raw)
+            orders_result = parse_mcp_result_json_marker(orders_raw)
             
             logger.info(f"📦 Orders result type: {type(orders_result)}")
             if orders_result:
@@ -491,14 +598,7 @@ async def get_dashboard_data(request: Request):
             
             if orders_result and isinstance(orders_result, dict):
                 # JSON estructurado de Dropi v6
-                dropi_data["pedidos"]["total"] = int(orders_result.get("total_orders", 0))
-                dropi_data["pedidos"]["monto"] = float(orders_result.get("total_amount", 0))
-                
-                dropi_data["entregas"]["total"] = int(orders_result.get("delivered", 0))
-                dropi_data["entregas"]["monto"] = float(orders_result.get("delivered_amount", 0))
-                
-                dropi_data["devoluciones"]["total"] = int(orders_result.get("returned", 0))
-                dropi_data["devoluciones"]["monto"] = float(orders_result.get("returned_amount", 0))
+                _ingest(orders_result, dropi_data, _DROPI_ORDERS_SPEC)
                 
                 logger.info(f"📦 Pedidos: {dropi_data['pedidos']['total']}, Monto: Q{dropi_data['pedidos']['monto']:,.2f}")
                 logger.info(f"✅ Entregas: {dropi_data['entregas']['total']}")
@@ -554,12 +654,10 @@ async def get_dashboard_data(request: Request):
             spend_raw = await mcp_client.call_tool("meta", "get_ad_spend_by_period", {
                 "period": period
             })
-            spend_result = parse_mcp_result(spend_raw)
+            spend_result = parse_mcp_result_json_marker(spend_raw)
             
             if spend_result and isinstance(spend_result, dict):
-                meta_data["gasto"] = float(spend_result.get("spend", 0))
-                meta_data["cpm"] = float(spend_result.get("cpm", 0))
-                meta_data["ctr"] = float(spend_result.get("ctr", 0))
+                _ingest(spend_result, meta_data, _META_SPEND_SPEC)
                 
                 # FIX: Usar dropi_data["pedidos"]["total"]
                 if dropi_data["pedidos"]["total"] > 0:
@@ -613,7 +711,7 @@ async def get_dashboard_data(request: Request):
             sales_result = parse_mcp_result(sales_raw)
             
             if sales_result and isinstance(sales_result, dict):
-                shopify_data["pedidos"] = int(sales_result.get("total_orders", 0))
+                _ingest(sales_result, shopify_data, _SHOPIFY_SALES_SPEC)
                 logger.info(f"🛒 Pedidos Shopify: {shopify_data['pedidos']}")
         
         except Exception as e:
@@ -635,29 +733,25 @@ async def get_dashboard_data(request: Request):
         meta_data["roas"] = roas
         tiktok_data["roas"] = roas
         
-        response_data = {
-            "success": True,
-            "period": {
-                "start": start_date,
-                "end": end_date,
-                "label": period_label
-            },
-            "master": {
-                "gastosAds": round(gastos_ads, 2),
-                "ingresosDropi": round(ingresos_dropi, 2),
-                "egresosDropi": round(egresos_dropi, 2),
-                "profitNeto": round(profit_neto, 2),
-                "roi": round(roi, 2)
-            },
-            "dropi": dropi_data,
-            "meta": meta_data,
-            "tiktok": tiktok_data,
-            "shopify": shopify_data
-        }
+        master = (gastos_ads, ingresos_dropi, egresos_dropi, profit_neto, roi)
+        # %.2f escribiria nan/inf, que no es JSON valido: mejor responder el error 500
+        if not all(math.isfinite(v) for v in master):
+            raise ValueError(f"Metricas master no finitas: {master}")
+        
+        body = _DASHBOARD_TMPL % (
+            orjson.dumps(start_date),
+            orjson.dumps(end_date),
+            orjson.dumps(period_label),
+            *master,
+            orjson.dumps(dropi_data),
+            orjson.dumps(meta_data),
+            orjson.dumps(tiktok_data),
+            orjson.dumps(shopify_data),
+        )
         
         logger.info(f"✅ Dashboard OK - Pedidos: {dropi_data['pedidos']['total']}, Monto: Q{dropi_data['pedidos']['monto']:,.2f}")
         
-        return JSONResponse(response_data)
+        return Response(content=body, media_type="application/json")
         
     except Exception as e:
         logger.error(f"❌ Error dashboard: {e}")
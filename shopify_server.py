@@ -5,15 +5,28 @@ Lee campos personalizados de Releasit COD Form (note_attributes).
 """
 
 import os
-import json
+import time
+import datetime
+import uuid
+import heapq
+import functools
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import NamedTuple
 import httpx
+import orjson
+import msgspec
 import asyncio
+import redis.asyncio as redis
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from starlette.applications import Starlette
 from starlette.routing import Route
-from starlette.responses import Response, JSONResponse
+from starlette.responses import Response
+from starlette.background import BackgroundTask
 from sse_starlette.sse import EventSourceResponse
 import uvicorn
+from mcp_transport import ORJSONResponse, read_json, rpc_envelope, rpc_unknown, build_rpc_methods, today_iso
 
 load_dotenv()
 
@@ -21,16 +34,66 @@ SHOPIFY_SHOP_URL = os.getenv("SHOPIFY_SHOP_URL", "").replace("https://", "").rep
 SHOPIFY_ACCESS_TOKEN = os.getenv("SHOPIFY_ACCESS_TOKEN", "")
 API_VERSION = "2024-01"
 
+# session_id -> SessionBuffer con los mensajes pendientes del stream SSE
 sessions = {}
+SESSION_BUFFER_SIZE = 256
 
-def get_base_url():
-    return f"https://{SHOPIFY_SHOP_URL}/admin/api/{API_VERSION}"
+# Registro de sesiones en Redis para correr varios workers: el POST a
+# /messages puede caer en un worker distinto al que tiene el stream SSE, y
+# la respuesta viaja por pub/sub al canal de la sesion. Sin REDIS_URL todo
+# queda en memoria del proceso.
+REDIS_URL = os.getenv("REDIS_URL", "")
+SESSIONS_KEY = "mcp:sessions"
+SESSION_TTL = 3600
+SESSION_REFRESH = 60
+_redis: redis.Redis = None
 
-def get_headers():
-    return {
-        "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
-        "Content-Type": "application/json"
-    }
+# Cliente HTTP compartido (keep-alive + HTTP/2), se crea en el lifespan
+_client: httpx.AsyncClient = None
+
+# Shopify limita la API REST por tienda (leaky bucket, ~2 req/s). Todas las
+# peticiones pasan por un mismo semaforo y los 429 se reintentan respetando
+# Retry-After (o con backoff exponencial si no viene)
+SHOPIFY_CONCURRENCY = int(os.getenv("SHOPIFY_CONCURRENCY", 2))
+RATE_LIMIT_RETRIES = 5
+RATE_LIMIT_BACKOFF = 0.5
+_shop_semaphore = asyncio.Semaphore(SHOPIFY_CONCURRENCY)
+
+# Cache TTL de lecturas: segundos por endpoint (los no listados usan el default)
+CACHE_TTLS = {
+    "shop.json": 3600,
+    "products.json": 120,
+    "customers.json": 60,
+    "orders.json": 30,
+    "graphql.json": 120,
+}
+DEFAULT_CACHE_TTL = 15
+CACHE_MAX_ENTRIES = 256
+
+_cache = {}
+# Fetches en vuelo por clave (single-flight): los pedidos identicos
+# concurrentes esperan el mismo Future en vez de repetir la llamada
+_inflight = {}
+
+# Paginacion por cursor: tope de paginas por consulta
+MAX_PAGES = 20
+
+# Selectores fields=: Shopify solo envia lo que cada herramienta lee
+SALES_FIELDS = "total_price,financial_status"
+LINE_ITEMS_FIELDS = "line_items"
+RECENT_ORDER_FIELDS = (
+    "id,order_number,total_price,financial_status,created_at,line_items,"
+    "note_attributes,billing_address,shipping_address,customer,email,contact_email,phone"
+)
+PRODUCT_FIELDS = "title,status,variants"
+CUSTOMER_FIELDS = "first_name,last_name,email,phone,orders_count,total_spent"
+
+# Base y headers de la Admin API, armados una vez al importar
+BASE_URL = f"https://{SHOPIFY_SHOP_URL}/admin/api/{API_VERSION}"
+HEADERS = {
+    "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
+    "Content-Type": "application/json"
+}
 
 def get_note_attribute(order, key):
     """Obtiene un atributo de note_attributes por nombre."""
@@ -41,70 +104,69 @@ def get_note_attribute(order, key):
             return attr.get("value", "")
     return ""
 
-def get_customer_name(order):
-    """Obtiene el nombre del cliente de note_attributes, billing, shipping o customer."""
-    
-    # 1. Primero buscar en note_attributes (Releasit COD Form)
-    nombre = get_note_attribute(order, "nombre")
-    apellido = get_note_attribute(order, "apellido")
+def find_note(notes, key):
+    """Como get_note_attribute pero sobre note_attributes ya normalizados."""
+    for attr_name, value in notes:
+        if key in attr_name:
+            return value
+    return ""
+
+def _customer_name(notes, billing, shipping, customer):
+    # 1. Primero note_attributes (Releasit COD Form) y sus variaciones comunes
+    nombre = find_note(notes, "nombre")
+    apellido = find_note(notes, "apellido")
     if nombre or apellido:
         return f"{nombre} {apellido}".strip()
     
-    # También buscar variaciones comunes
-    name = get_note_attribute(order, "name")
+    name = find_note(notes, "name")
     if name:
         return name
     
-    first_name = get_note_attribute(order, "first_name") or get_note_attribute(order, "first name")
-    last_name = get_note_attribute(order, "last_name") or get_note_attribute(order, "last name")
+    first_name = find_note(notes, "first_name") or find_note(notes, "first name")
+    last_name = find_note(notes, "last_name") or find_note(notes, "last name")
     if first_name or last_name:
         return f"{first_name} {last_name}".strip()
     
-    # 2. Luego billing_address
-    billing = order.get("billing_address", {})
-    if billing:
-        name = f"{billing.get('first_name', '')} {billing.get('last_name', '')}".strip()
-        if name:
-            return name
-    
-    # 3. Luego shipping_address
-    shipping = order.get("shipping_address", {})
-    if shipping:
-        name = f"{shipping.get('first_name', '')} {shipping.get('last_name', '')}".strip()
-        if name:
-            return name
-    
-    # 4. Finalmente customer
-    customer = order.get("customer", {})
-    if customer:
-        name = f"{customer.get('first_name', '')} {customer.get('last_name', '')}".strip()
-        if name:
-            return name
+    # 2. Luego billing_address, shipping_address y customer
+    for source in (billing, shipping, customer):
+        if source:
+            name = f"{source.get('first_name', '')} {source.get('last_name', '')}".strip()
+            if name:
+                return name
     
     return "Sin nombre"
 
-def get_customer_contact(order):
-    """Obtiene teléfono/WhatsApp y email del cliente."""
-    
-    # 1. Buscar en note_attributes primero (Releasit COD Form)
-    phone = get_note_attribute(order, "whatsapp") or get_note_attribute(order, "telefono") or get_note_attribute(order, "phone") or get_note_attribute(order, "celular")
-    
-    # 2. Buscar email en note_attributes
-    email = get_note_attribute(order, "email") or get_note_attribute(order, "correo")
+def get_customer_info(order):
+    """
+    Obtiene (nombre, email, teléfono) del cliente recorriendo el pedido una sola vez.
+    Prioridad: note_attributes (Releasit COD Form), billing, shipping, customer.
+    """
+    notes = [(attr.get("name", "").lower(), attr.get("value", "")) for attr in order.get("note_attributes", [])]
+    billing = order.get("billing_address") or {}
+    shipping = order.get("shipping_address") or {}
+    customer = order.get("customer") or {}
+    
+    name = _customer_name(notes, billing, shipping, customer)
+    
+    # Contacto: note_attributes primero, luego campos estándar
+    phone = find_note(notes, "whatsapp") or find_note(notes, "telefono") or find_note(notes, "phone") or find_note(notes, "celular")
+    email = find_note(notes, "email") or find_note(notes, "correo")
     
-    # 3. Si no hay, buscar en campos estándar
     if not phone:
-        billing = order.get("billing_address", {})
-        shipping = order.get("shipping_address", {})
         phone = billing.get("phone") or shipping.get("phone") or order.get("phone") or ""
     
     if not email:
-        email = order.get("email") or order.get("contact_email") or ""
-        if not email:
-            customer = order.get("customer", {})
-            email = customer.get("email", "")
+        email = order.get("email") or order.get("contact_email") or customer.get("email", "")
     
-    return email or "Sin email", phone or "Sin teléfono"
+    return name, email or "Sin email", phone or "Sin teléfono"
+
+def iso_date(s: str) -> str:
+    """'2025-12-05T10:11:12-05:00' -> '2025-12-05'."""
+    return s[:10]
+
+def iso_datetime(s: str) -> str:
+    """'2025-12-05T10:11:12-05:00' -> '2025-12-05 10:11:12' sin recorrer el string."""
+    return f"{s[:10]} {s[11:19]}" if len(s) >= 19 else s
 
 def get_customer_address(order):
     """Obtiene la dirección del cliente."""
@@ -272,95 +334,316 @@ TOOLS = [
     }
 ]
 
+# ========== ESQUEMAS PARCIALES ==========
+# msgspec solo materializa los campos declarados y salta el resto del JSON
+# (direcciones, impuestos, metafields...) sin crear objetos Python.
+
+class LineItem(msgspec.Struct):
+    name: str | None = "Producto"
+    quantity: int = 1
+
+class OrderLineItems(msgspec.Struct):
+    line_items: list[LineItem] = []
+
+class OrdersLineItemsResponse(msgspec.Struct):
+    orders: list[OrderLineItems] = []
+
+_ORDERS_LINE_ITEMS_DECODER = msgspec.json.Decoder(OrdersLineItemsResponse)
+
+class SaleOrder(msgspec.Struct):
+    total_price: float = 0.0
+    financial_status: str | None = None
+
+class SalesOrdersResponse(msgspec.Struct):
+    orders: list[SaleOrder] = []
+
+# strict=False: Shopify manda los montos como string y msgspec los convierte a float en C
+_SALES_ORDERS_DECODER = msgspec.json.Decoder(SalesOrdersResponse, strict=False)
+
 # ========== IMPLEMENTACION ==========
 
+class ShopifyAPIError(Exception):
+    """Respuesta no exitosa de la API de Shopify (la maneja execute_tool)."""
+
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"HTTP {response.status_code}: {response.text}")
+        self.status_code = response.status_code
+
+def ttl_cached(func):
+    """Cachea respuestas por (endpoint, params) durante su TTL; los errores no se cachean."""
+    @functools.wraps(func)
+    async def wrapper(endpoint: str, params: dict = None):
+        key = (func.__name__, endpoint, frozenset(params.items()) if params else None)
+        while True:
+            hit = _cache.get(key)
+            if hit and hit[0] > time.monotonic():
+                return hit[1]
+            
+            fut = _inflight.get(key)
+            if fut is None:
+                break
+            # shield: cancelar a un espectador no cancela el fetch compartido.
+            # Si el que hacia el fetch fue cancelado, se reintenta.
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise
+        
+        fut = _inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            data = await func(endpoint, params)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            # El error le llega a todos los que esperaban, sin cachearlo
+            fut.set_exception(e)
+            fut.exception()
+            raise
+        finally:
+            _inflight.pop(key, None)
+        
+        now = time.monotonic()
+        if len(_cache) >= CACHE_MAX_ENTRIES:
+            for k in [k for k, (expires, _) in _cache.items() if expires <= now]:
+                del _cache[k]
+        _cache[key] = (now + CACHE_TTLS.get(endpoint, DEFAULT_CACHE_TTL), data)
+        fut.set_result(data)
+        return data
+    
+    return wrapper
+
+async def shopify_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Peticion a Shopify dentro del semaforo de la tienda, reintentando los 429."""
+    async with _shop_semaphore:
+        for attempt in range(RATE_LIMIT_RETRIES):
+            response = await _client.request(method, url, **kwargs)
+            if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES - 1:
+                break
+            # Se espera con el semaforo tomado: el limite es de toda la tienda
+            await asyncio.sleep(float(response.headers.get("Retry-After", RATE_LIMIT_BACKOFF * 2 ** attempt)))
+        return response
+
+async def shopify_get(url: str, params: dict = None) -> httpx.Response:
+    return await shopify_request("GET", url, params=params)
+
+@ttl_cached
 async def api_get(endpoint: str, params: dict = None):
-    url = f"{get_base_url()}/{endpoint}"
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.get(url, headers=get_headers(), params=params)
-        if response.status_code != 200:
-            return {"error": f"HTTP {response.status_code}: {response.text}"}
-        return response.json()
+    response = await shopify_get(endpoint, params)
+    if response.status_code != 200:
+        raise ShopifyAPIError(response)
+    return orjson.loads(response.content)
+
+async def api_get_pages(endpoint: str, params: dict = None, decode=orjson.loads):
+    """
+    Recorre la paginacion de Shopify (header Link rel="next"), sin cache.
+    Mientras el llamador procesa una pagina, la siguiente ya se esta descargando.
+    Entrega (pagina decodificada con `decode`, truncado): truncado es True solo
+    en la ultima pagina cuando quedaban mas y se corto por MAX_PAGES.
+    """
+    pending = asyncio.ensure_future(shopify_get(endpoint, params))
+    try:
+        for page in range(MAX_PAGES):
+            response = await pending
+            pending = None
+            if response.status_code != 200:
+                raise ShopifyAPIError(response)
+            
+            next_url = response.links.get("next", {}).get("url")
+            truncated = bool(next_url) and page + 1 >= MAX_PAGES
+            if next_url and not truncated:
+                pending = asyncio.ensure_future(shopify_get(next_url))
+            
+            yield decode(response.content), truncated
+            
+            if pending is None:
+                return
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+# Busqueda de productos por titulo en la API GraphQL: Shopify filtra del lado
+# del servidor y solo viajan los productos que coinciden
+PRODUCT_SEARCH_QUERY = """
+query($q: String!) {
+  products(first: 50, query: $q) {
+    edges { node { title variants(first: 100) { edges { node { title inventoryQuantity } } } } }
+  }
+}
+"""
+
+# Si la tienda no tiene GraphQL o el scope read_inventory, no se reintenta
+# hasta que pase el TTL (monotonic): cada intento fallido gasta un cupo del semaforo
+_graphql_unavailable_until = 0.0
+
+def graphql_available() -> bool:
+    return time.monotonic() >= _graphql_unavailable_until
+
+def mark_graphql_unavailable():
+    global _graphql_unavailable_until
+    _graphql_unavailable_until = time.monotonic() + CACHE_TTLS["graphql.json"]
+
+def title_search_query(needle: str) -> str:
+    """'camisa roja' -> 'title:*camisa* title:*roja*' (escapando la sintaxis de busqueda)."""
+    terms = []
+    for word in needle.split():
+        for ch in '\\":()':
+            word = word.replace(ch, "\\" + ch)
+        terms.append(f"title:*{word}*")
+    return " ".join(terms)
+
+@ttl_cached
+async def api_search_products(endpoint: str, params: dict = None) -> list:
+    """
+    Ejecuta PRODUCT_SEARCH_QUERY con params como variables.
+    Devuelve [(titulo, [(variante, cantidad)])]; los errores GraphQL se
+    levantan como ShopifyAPIError. Los de permisos o esquema ademas apagan
+    GraphQL por un TTL; el throttling no, es pasajero.
+    """
+    response = await shopify_request("POST", endpoint, json={"query": PRODUCT_SEARCH_QUERY, "variables": params})
+    if response.status_code in (401, 403, 404):
+        mark_graphql_unavailable()
+    if response.status_code != 200:
+        raise ShopifyAPIError(response)
+    data = orjson.loads(response.content)
+    errors = data.get("errors")
+    if errors or not data.get("data"):
+        throttled = isinstance(errors, list) and any(
+            isinstance(e, dict) and e.get("extensions", {}).get("code") == "THROTTLED" for e in errors
+        )
+        if not throttled:
+            mark_graphql_unavailable()
+        raise ShopifyAPIError(response)
+    return [
+        (node["title"], [(v["node"]["title"], v["node"]["inventoryQuantity"] or 0) for v in node["variants"]["edges"]])
+        for node in (edge["node"] for edge in data["data"]["products"]["edges"])
+    ]
+
+def summarize_orders(orders: list[SaleOrder]) -> tuple:
+    """Agrega en una sola pasada: (total, total pagado, pagados, pendientes)."""
+    total = paid_total = 0.0
+    paid = pending = 0
+    for o in orders:
+        price = o.total_price
+        total += price
+        status = o.financial_status
+        if status == "paid":
+            paid_total += price
+            paid += 1
+        elif status == "pending":
+            pending += 1
+    return total, paid_total, paid, pending
+
+@ttl_cached
+async def api_sales_summary(endpoint: str, params: dict = None) -> tuple:
+    """
+    Recorre todas las paginas de pedidos y devuelve
+    (pedidos, total, total pagado, pagados, pendientes, truncado).
+    Se cachea el agregado, no las paginas.
+    """
+    order_count = paid = pending = 0
+    total = paid_total = 0.0
+    truncated = False
+    async for data, truncated in api_get_pages(endpoint, params, _SALES_ORDERS_DECODER.decode):
+        page_total, page_paid_total, page_paid, page_pending = summarize_orders(data.orders)
+        order_count += len(data.orders)
+        total += page_total
+        paid_total += page_paid_total
+        paid += page_paid
+        pending += page_pending
+    return order_count, total, paid_total, paid, pending, truncated
+
+@ttl_cached
+async def api_product_sales(endpoint: str, params: dict = None) -> tuple:
+    """
+    Unidades vendidas por producto en todas las paginas de pedidos:
+    (Counter nombre -> cantidad, pedidos leidos, truncado).
+    Se cachea el agregado, igual que api_sales_summary.
+    """
+    product_sales = Counter()
+    order_count = 0
+    truncated = False
+    # Cada pagina se acumula mientras la siguiente se descarga
+    async for data, truncated in api_get_pages(endpoint, params, _ORDERS_LINE_ITEMS_DECODER.decode):
+        order_count += len(data.orders)
+        for order in data.orders:
+            for item in order.line_items:
+                product_sales[item.name] += item.quantity
+    return product_sales, order_count, truncated
+
+def truncation_note(truncated: bool, order_count: int) -> str:
+    """Aviso para el texto de la herramienta cuando la paginacion se corto en MAX_PAGES."""
+    if not truncated:
+        return ""
+    return f"\n⚠️ Solo se leyeron los ultimos {order_count} pedidos (limite de {MAX_PAGES} paginas)"
 
 async def get_total_sales_today(args: dict) -> str:
-    import datetime
-    today = datetime.date.today().isoformat()
-    data = await api_get("orders.json", {"created_at_min": today, "status": "any"})
-    
-    if "error" in data:
-        return f"Error: {data['error']}"
-    
-    orders = data.get("orders", [])
-    total = sum(float(o.get("total_price", 0)) for o in orders)
-    paid = len([o for o in orders if o.get("financial_status") == "paid"])
-    pending = len([o for o in orders if o.get("financial_status") == "pending"])
+    today = today_iso()
+    order_count, total, _, paid, pending, truncated = await api_sales_summary(
+        "orders.json", {"created_at_min": today, "status": "any", "limit": 250, "fields": SALES_FIELDS}
+    )
     
     return f"""📊 VENTAS DE HOY ({today}):
 💰 Total: ${total:,.2f}
-📦 Pedidos: {len(orders)}
+📦 Pedidos: {order_count}
 ✅ Pagados: {paid}
-⏳ Pendientes: {pending}"""
+⏳ Pendientes: {pending}""" + truncation_note(truncated, order_count)
 
 async def get_recent_orders(args: dict) -> str:
     limit = min(args.get("limit", 10), 50)
     status = args.get("status", "any")
     
-    data = await api_get("orders.json", {"limit": limit, "status": status})
-    
-    if "error" in data:
-        return f"Error: {data['error']}"
+    data = await api_get("orders.json", {"limit": limit, "status": status, "fields": RECENT_ORDER_FIELDS})
     
     orders = data.get("orders", [])
     if not orders:
         return "No hay pedidos recientes."
     
-    result = f"📦 ULTIMOS {len(orders)} PEDIDOS:\n\n"
+    parts = [f"📦 ULTIMOS {len(orders)} PEDIDOS:\n\n"]
     
     for o in orders:
         order_num = o.get("order_number", o.get("id"))
-        name = get_customer_name(o)
-        email, phone = get_customer_contact(o)
+        name, email, phone = get_customer_info(o)
         total = float(o.get("total_price", 0))
         fin_status = o.get("financial_status", "unknown")
-        created = o.get("created_at", "")[:10]
+        created = iso_date(o.get("created_at", ""))
         
         items = o.get("line_items", [])
         products = ", ".join([f"{i.get('name', 'Producto')} x{i.get('quantity', 1)}" for i in items[:2]])
         if len(items) > 2:
             products += f" (+{len(items)-2} mas)"
         
-        result += f"""🔹 Pedido #{order_num} - {created}
+        parts.append(f"""🔹 Pedido #{order_num} - {created}
    👤 {name}
    📱 {phone}
    🛒 {products}
    💵 ${total:,.2f} - {fin_status}
 
-"""
+""")
     
-    return result
+    return "".join(parts)
 
 async def get_order_details(args: dict) -> str:
     order_id = args.get("order_id", "")
     
     data = await api_get("orders.json", {"name": order_id, "status": "any"})
     
-    if "error" in data:
-        return f"Error: {data['error']}"
-    
     orders = data.get("orders", [])
     if not orders:
-        data = await api_get(f"orders/{order_id}.json")
-        if "error" in data:
+        # Casi siempre llega el numero del pedido: el ID interno solo se prueba si no aparece
+        try:
+            data = await api_get(f"orders/{order_id}.json")
+        except ShopifyAPIError:
             return f"No encontre el pedido #{order_id}"
         order = data.get("order", {})
     else:
         order = orders[0]
     
-    name = get_customer_name(order)
-    email, phone = get_customer_contact(order)
+    name, email, phone = get_customer_info(order)
     address = get_customer_address(order)
     
-    result = f"""📋 DETALLE PEDIDO #{order.get('order_number', order.get('id'))}
+    parts = [f"""📋 DETALLE PEDIDO #{order.get('order_number', order.get('id'))}
 
 👤 CLIENTE:
    Nombre: {name}
@@ -371,12 +654,12 @@ async def get_order_details(args: dict) -> str:
    {address}
 
 🛒 PRODUCTOS:
-"""
+"""]
     
     for item in order.get("line_items", []):
-        result += f"   - {item.get('name')} x{item.get('quantity')} = ${float(item.get('price', 0)):,.2f}\n"
+        parts.append(f"   - {item.get('name')} x{item.get('quantity')} = ${float(item.get('price', 0)):,.2f}\n")
     
-    result += f"""
+    parts.append(f"""
 💰 RESUMEN:
    Subtotal: ${float(order.get('subtotal_price', 0)):,.2f}
    Envio: ${float(order.get('total_shipping_price_set', {}).get('shop_money', {}).get('amount', 0)):,.2f}
@@ -385,21 +668,19 @@ async def get_order_details(args: dict) -> str:
 📊 ESTADO:
    Pago: {order.get('financial_status', 'N/A')}
    Envio: {order.get('fulfillment_status') or 'No enviado'}
-   Fecha: {order.get('created_at', '')[:19].replace('T', ' ')}
-"""
+   Fecha: {iso_datetime(order.get('created_at', ''))}
+""")
     
     # Mostrar todos los note_attributes si hay
     note_attrs = order.get("note_attributes", [])
     if note_attrs:
-        result += "\n📝 INFO ADICIONAL:\n"
+        parts.append("\n📝 INFO ADICIONAL:\n")
         for attr in note_attrs:
-            result += f"   {attr.get('name')}: {attr.get('value')}\n"
+            parts.append(f"   {attr.get('name')}: {attr.get('value')}\n")
     
-    return result
+    return "".join(parts)
 
 async def get_sales_by_period(args: dict) -> str:
-    import datetime
-    
     # DEBUG - Ver qué recibimos
     print(f"📊 SHOPIFY get_sales_by_period - Args recibidos: {args}")
     
@@ -411,7 +692,7 @@ async def get_sales_by_period(args: dict) -> str:
     start_date_param = args.get("start_date")
     end_date_param = args.get("end_date")
     period = args.get("period", "today")
-    today = datetime.date.today()
+    today = datetime.date.fromisoformat(today_iso())
     
     print(f"📊 start_date_param: {start_date_param}, end_date_param: {end_date_param}, period: {period}")
     
@@ -458,58 +739,48 @@ async def get_sales_by_period(args: dict) -> str:
     
     print(f"📊 Query Shopify: created_at_min={created_at_min}, created_at_max={created_at_max}")
     
-    data = await api_get("orders.json", {
+    order_count, total, paid_total, paid_count, _, truncated = await api_sales_summary("orders.json", {
         "created_at_min": created_at_min,
         "created_at_max": created_at_max,
         "status": "any",
-        "limit": 250
+        "limit": 250,
+        "fields": SALES_FIELDS
     })
     
-    if "error" in data:
-        return f"Error: {data['error']}"
-    
-    orders = data.get("orders", [])
-    print(f"📊 Shopify devolvió {len(orders)} pedidos para el rango {start_date} a {end_date}")
-    
-    total = sum(float(o.get("total_price", 0)) for o in orders)
-    paid_orders = [o for o in orders if o.get("financial_status") == "paid"]
-    paid_total = sum(float(o.get("total_price", 0)) for o in paid_orders)
+    print(f"📊 Shopify devolvió {order_count} pedidos para el rango {start_date} a {end_date}")
     
     # Texto formateado
     result_text = f"""📊 VENTAS {label}:
 
 💰 Total bruto: ${total:,.2f}
 ✅ Total pagado: ${paid_total:,.2f}
-📦 Pedidos totales: {len(orders)}
-✅ Pedidos pagados: {len(paid_orders)}
-📈 Ticket promedio: ${(total/len(orders) if orders else 0):,.2f}"""
+📦 Pedidos totales: {order_count}
+✅ Pedidos pagados: {paid_count}
+📈 Ticket promedio: ${(total/order_count if order_count else 0):,.2f}""" + truncation_note(truncated, order_count)
     
     # JSON estructurado para el dashboard
     json_data = {
-        "total_orders": len(orders),
+        "total_orders": order_count,
         "total_amount": round(total, 2),
-        "paid_orders": len(paid_orders),
+        "paid_orders": paid_count,
         "paid_amount": round(paid_total, 2),
-        "avg_ticket": round(total/len(orders), 2) if orders else 0,
+        "avg_ticket": round(total/order_count, 2) if order_count else 0,
         "period": label,
         "start_date": start_date,
         "end_date": end_date
     }
     
-    return f"{result_text}\n\n---JSON---\n{json.dumps(json_data)}"
+    return f"{result_text}\n\n---JSON---\n{orjson.dumps(json_data).decode()}"
 
 async def get_all_products(args: dict) -> str:
     limit = min(args.get("limit", 50), 250)
-    data = await api_get("products.json", {"limit": limit})
-    
-    if "error" in data:
-        return f"Error: {data['error']}"
+    data = await api_get("products.json", {"limit": limit, "fields": PRODUCT_FIELDS})
     
     products = data.get("products", [])
     if not products:
         return "No hay productos en la tienda."
     
-    result = f"🏪 PRODUCTOS ({len(products)}):\n\n"
+    parts = [f"🏪 PRODUCTOS ({len(products)}):\n\n"]
     
     for p in products:
         title = p.get("title", "Sin nombre")
@@ -526,27 +797,70 @@ async def get_all_products(args: dict) -> str:
         status_emoji = "✅" if status == "active" else "⏸️"
         inv_warning = "⚠️" if total_inv < 5 else ""
         
-        result += f"{status_emoji} {title}\n   💵 ${price} | 📦 {total_inv} unidades {inv_warning}\n\n"
+        parts.append(f"{status_emoji} {title}\n   💵 ${price} | 📦 {total_inv} unidades {inv_warning}\n\n")
     
-    return result
+    return "".join(parts)
+
+def inventory_text(title: str, variants: list) -> str:
+    """Bloque de texto de un producto a partir de [(variante, cantidad)]."""
+    return f"📦 {title}\n" + "\n".join(f"   - {name}: {qty} unidades" for name, qty in variants)
+
+class InventoryEntry(NamedTuple):
+    title: str
+    title_lower: str
+    status: str
+    total_inventory: int
+    text: str
+
+@dataclass
+class InventoryIndex:
+    """Productos de una respuesta de products.json con titulo en minusculas,
+    inventario total y bloque de texto ya calculados."""
+    entries: list
+
+    @classmethod
+    def build(cls, data: dict) -> "InventoryIndex":
+        entries = []
+        for p in data.get("products", []):
+            title = p["title"]
+            variants = [(v.get("title", "Default"), v.get("inventory_quantity", 0)) for v in p.get("variants", [])]
+            total = sum(qty for _, qty in variants)
+            entries.append(InventoryEntry(title, title.lower(), p.get("status"), total, inventory_text(title, variants)))
+        return cls(entries)
+
+    def search(self, needle: str) -> list:
+        return [e for e in self.entries if needle in e.title_lower]
+
+@ttl_cached
+async def api_inventory_index(endpoint: str, params: dict = None) -> InventoryIndex:
+    """
+    InventoryIndex de una respuesta de products.json. Se cachea el indice,
+    no la respuesta: se reconstruye solo cuando vence el TTL.
+    """
+    response = await shopify_get(endpoint, params)
+    if response.status_code != 200:
+        raise ShopifyAPIError(response)
+    return InventoryIndex.build(orjson.loads(response.content))
 
 async def check_product_inventory(args: dict) -> str:
     product_name = args.get("product_name", "")
-    data = await api_get("products.json")
-    
-    if "error" in data:
-        return f"Error: {data['error']}"
+    needle = product_name.lower()
     
-    products = data.get("products", [])
-    found = []
+    found = None
+    if needle.strip() and graphql_available():
+        try:
+            products = await api_search_products("graphql.json", {"q": title_search_query(needle)})
+            # La busqueda de Shopify es por palabras: se re-filtra por substring exacto
+            found = [inventory_text(title, variants) for title, variants in products if needle in title.lower()]
+        except ShopifyAPIError:
+            pass
     
-    for p in products:
-        if product_name.lower() in p["title"].lower():
-            variants = p.get("variants", [])
-            variant_info = []
-            for v in variants:
-                variant_info.append(f"   - {v.get('title', 'Default')}: {v.get('inventory_quantity', 0)} unidades")
-            found.append(f"📦 {p['title']}\n" + "\n".join(variant_info))
+    # Si GraphQL fallo, no hay acceso o no encontro nada: filtro local por substring
+    # sobre el indice cacheado de products.json. La busqueda por palabras de Shopify
+    # (title:*palabra*, first: 50) puede perder titulos que el substring si encuentra.
+    if not found:
+        index = await api_inventory_index("products.json", {"limit": 250, "fields": PRODUCT_FIELDS})
+        found = [e.text for e in index.search(needle)]
     
     if not found:
         return f"No encontre productos con '{product_name}'"
@@ -555,21 +869,13 @@ async def check_product_inventory(args: dict) -> str:
 
 async def get_low_stock_products(args: dict) -> str:
     threshold = args.get("threshold", 5)
-    data = await api_get("products.json", {"limit": 250})
+    index = await api_inventory_index("products.json", {"limit": 250, "fields": PRODUCT_FIELDS})
     
-    if "error" in data:
-        return f"Error: {data['error']}"
-    
-    products = data.get("products", [])
-    low_stock = []
-    
-    for p in products:
-        if p.get("status") != "active":
-            continue
-        variants = p.get("variants", [])
-        total_inv = sum(v.get("inventory_quantity", 0) for v in variants)
-        if total_inv < threshold:
-            low_stock.append(f"⚠️ {p['title']}: {total_inv} unidades")
+    low_stock = [
+        f"⚠️ {e.title}: {e.total_inventory} unidades"
+        for e in index.entries
+        if e.status == "active" and e.total_inventory < threshold
+    ]
     
     if not low_stock:
         return f"✅ No hay productos con menos de {threshold} unidades."
@@ -578,16 +884,13 @@ async def get_low_stock_products(args: dict) -> str:
 
 async def get_recent_customers(args: dict) -> str:
     limit = min(args.get("limit", 10), 50)
-    data = await api_get("customers.json", {"limit": limit, "order": "created_at desc"})
-    
-    if "error" in data:
-        return f"Error: {data['error']}"
+    data = await api_get("customers.json", {"limit": limit, "order": "created_at desc", "fields": CUSTOMER_FIELDS})
     
     customers = data.get("customers", [])
     if not customers:
         return "No hay clientes registrados."
     
-    result = f"👥 CLIENTES RECIENTES ({len(customers)}):\n\n"
+    parts = [f"👥 CLIENTES RECIENTES ({len(customers)}):\n\n"]
     
     for c in customers:
         name = f"{c.get('first_name', '')} {c.get('last_name', '')}".strip() or "Sin nombre"
@@ -596,57 +899,49 @@ async def get_recent_customers(args: dict) -> str:
         orders = c.get("orders_count", 0)
         total = float(c.get("total_spent", 0))
         
-        result += f"👤 {name}\n   📧 {email} | 📱 {phone}\n   🛒 {orders} pedidos | 💰 ${total:,.2f}\n\n"
+        parts.append(f"👤 {name}\n   📧 {email} | 📱 {phone}\n   🛒 {orders} pedidos | 💰 ${total:,.2f}\n\n")
     
-    return result
+    return "".join(parts)
 
 async def search_customer(args: dict) -> str:
     query = args.get("query", "")
     data = await api_get("customers/search.json", {"query": query})
     
-    if "error" in data:
-        return f"Error: {data['error']}"
-    
     customers = data.get("customers", [])
     if not customers:
         return f"No encontre clientes con '{query}'"
     
-    result = "🔍 CLIENTES ENCONTRADOS:\n\n"
+    parts = ["🔍 CLIENTES ENCONTRADOS:\n\n"]
     
     for c in customers:
         name = f"{c.get('first_name', '')} {c.get('last_name', '')}".strip()
-        result += f"👤 {name}\n   📧 {c.get('email', 'N/A')} | 📱 {c.get('phone', 'N/A')}\n   🛒 {c.get('orders_count', 0)} pedidos | 💰 ${float(c.get('total_spent', 0)):,.2f}\n\n"
+        parts.append(f"👤 {name}\n   📧 {c.get('email', 'N/A')} | 📱 {c.get('phone', 'N/A')}\n   🛒 {c.get('orders_count', 0)} pedidos | 💰 ${float(c.get('total_spent', 0)):,.2f}\n\n")
     
-    return result
+    return "".join(parts)
 
 async def get_top_customers(args: dict) -> str:
     limit = min(args.get("limit", 10), 50)
-    data = await api_get("customers.json", {"limit": 250})
-    
-    if "error" in data:
-        return f"Error: {data['error']}"
+    data = await api_get("customers.json", {"limit": 250, "fields": CUSTOMER_FIELDS})
     
     customers = data.get("customers", [])
-    customers.sort(key=lambda c: float(c.get("total_spent", 0)), reverse=True)
-    top = customers[:limit]
+    # total_spent se parsea una sola vez; nlargest evita ordenar toda la lista
+    spent = [(float(c.get("total_spent", 0)), c) for c in customers]
+    top = heapq.nlargest(limit, spent, key=lambda pair: pair[0])
     
     if not top:
         return "No hay clientes con compras."
     
-    result = f"🏆 TOP {len(top)} CLIENTES:\n\n"
+    parts = [f"🏆 TOP {len(top)} CLIENTES:\n\n"]
     
-    for i, c in enumerate(top, 1):
+    for i, (total_spent, c) in enumerate(top, 1):
         name = f"{c.get('first_name', '')} {c.get('last_name', '')}".strip() or "Sin nombre"
-        result += f"{i}. {name}: ${float(c.get('total_spent', 0)):,.2f} ({c.get('orders_count', 0)} pedidos)\n"
+        parts.append(f"{i}. {name}: ${total_spent:,.2f} ({c.get('orders_count', 0)} pedidos)\n")
     
-    return result
+    return "".join(parts)
 
 async def get_shop_info(args: dict) -> str:
     data = await api_get("shop.json")
     
-    if "error" in data:
-        return f"Error: {data['error']}"
-    
     shop = data.get("shop", {})
     
     return f"""🏪 INFO DE LA TIENDA:
@@ -659,12 +954,12 @@ async def get_shop_info(args: dict) -> str:
 💰 Moneda: {shop.get('currency', 'N/A')}
 🌍 Zona horaria: {shop.get('timezone', 'N/A')}
 📊 Plan: {shop.get('plan_name', 'N/A')}
-📅 Creada: {shop.get('created_at', 'N/A')[:10]}"""
+📅 Creada: {iso_date(shop.get('created_at', 'N/A'))}"""
 
 async def get_shop_balance(args: dict) -> str:
-    data = await api_get("shopify_payments/balance.json")
-    
-    if "error" in data:
+    try:
+        data = await api_get("shopify_payments/balance.json")
+    except ShopifyAPIError:
         return """💳 BALANCE:
 
 Para ver el balance completo, revisa:
@@ -673,37 +968,28 @@ Shopify Admin > Configuracion > Pagos
 La API tiene acceso limitado a info financiera."""
     
     balance = data.get("balance", [])
-    result = "💳 BALANCE SHOPIFY PAYMENTS:\n\n"
+    parts = ["💳 BALANCE SHOPIFY PAYMENTS:\n\n"]
     for b in balance:
-        result += f"   {b.get('currency', 'USD')}: ${float(b.get('amount', 0)):,.2f}\n"
-    return result
+        parts.append(f"   {b.get('currency', 'USD')}: ${float(b.get('amount', 0)):,.2f}\n")
+    return "".join(parts)
 
 async def get_best_selling_products(args: dict) -> str:
     limit = min(args.get("limit", 10), 50)
-    data = await api_get("orders.json", {"limit": 250, "status": "any"})
-    
-    if "error" in data:
-        return f"Error: {data['error']}"
-    
-    orders = data.get("orders", [])
-    product_sales = {}
-    
-    for order in orders:
-        for item in order.get("line_items", []):
-            name = item.get("name", "Producto")
-            qty = item.get("quantity", 1)
-            product_sales[name] = product_sales.get(name, 0) + qty
+    product_sales, order_count, truncated = await api_product_sales(
+        "orders.json", {"limit": 250, "status": "any", "fields": LINE_ITEMS_FIELDS}
+    )
     
-    sorted_products = sorted(product_sales.items(), key=lambda x: x[1], reverse=True)[:limit]
+    sorted_products = product_sales.most_common(limit)
     
     if not sorted_products:
         return "No hay datos de ventas."
     
-    result = f"🏆 TOP {len(sorted_products)} MAS VENDIDOS:\n\n"
+    scope = f" (ultimos {order_count} pedidos)" if truncated else ""
+    parts = [f"🏆 TOP {len(sorted_products)} MAS VENDIDOS{scope}:\n\n"]
     for i, (name, qty) in enumerate(sorted_products, 1):
-        result += f"{i}. {name}: {qty} vendidos\n"
+        parts.append(f"{i}. {name}: {qty} vendidos\n")
     
-    return result
+    return "".join(parts)
 
 # ========== DISPATCHER ==========
 
@@ -732,67 +1018,158 @@ async def execute_tool(name: str, args: dict) -> str:
             return f"Error ejecutando {name}: {str(e)}"
     return f"Herramienta {name} no encontrada"
 
+# ========== JSON-RPC (MCP) ==========
+
+RPC_METHODS, _TOOLS_BYTES = build_rpc_methods("shopify-mcp", "3.0.0", TOOLS, execute_tool)
+
 # ========== ENDPOINTS ==========
 
 async def http_tools(request):
-    return JSONResponse({"tools": TOOLS})
+    return Response(_TOOLS_BYTES, media_type="application/json")
 
 async def http_call_tool(request):
-    body = await request.json()
+    body = await read_json(request)
     name = body.get("name", "")
     args = body.get("arguments", {})
     result = await execute_tool(name, args)
-    return JSONResponse({"result": result})
+    return ORJSONResponse({"result": result})
+
+class SessionBuffer:
+    """
+    Mensajes pendientes de una sesion SSE: deque + Condition.
+    Con el buffer lleno el productor espera (back-pressure) en vez de crecer
+    sin limite; cerrado, put devuelve False y get devuelve None.
+    """
+
+    def __init__(self, maxlen: int = SESSION_BUFFER_SIZE):
+        self.buf = deque()
+        self.maxlen = maxlen
+        self.cond = asyncio.Condition()
+        self.closed = False
+
+    async def put(self, item) -> bool:
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.closed or len(self.buf) < self.maxlen)
+            if self.closed:
+                return False
+            self.buf.append(item)
+            self.cond.notify_all()
+            return True
+
+    async def get(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.closed or self.buf)
+            if not self.buf:
+                return None
+            item = self.buf.popleft()
+            self.cond.notify_all()
+            return item
+
+    async def close(self):
+        async with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+def session_channel(session_id: str) -> str:
+    return f"mcp:sess:{session_id}"
+
+async def relay_session(session_id: str, buffer: SessionBuffer):
+    """Reenvia al stream local lo publicado en Redis por otros workers y
+    mantiene viva la sesion en el sorted set."""
+    pubsub = _redis.pubsub()
+    await pubsub.subscribe(session_channel(session_id))
+    try:
+        refreshed = 0.0
+        while True:
+            now = time.time()
+            if now - refreshed >= SESSION_REFRESH:
+                await _redis.zadd(SESSIONS_KEY, {session_id: now})
+                await _redis.zremrangebyscore(SESSIONS_KEY, "-inf", now - SESSION_TTL)
+                refreshed = now
+            msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=SESSION_REFRESH)
+            if msg is not None and not await buffer.put(("message", msg["data"].decode())):
+                return
+    finally:
+        await _redis.zrem(SESSIONS_KEY, session_id)
+        await pubsub.aclose()
+
+async def session_exists(session_id: str) -> bool:
+    if _redis is None:
+        return False
+    return await _redis.zscore(SESSIONS_KEY, session_id) is not None
 
 async def sse_endpoint(request):
-    queue = asyncio.Queue()
-    session_id = str(id(queue))
-    sessions[session_id] = queue
+    # Los mensajes llegan al buffer como (evento, payload ya serializado)
+    buffer = SessionBuffer()
+    session_id = uuid.uuid4().hex
+    sessions[session_id] = buffer
     
     async def event_generator():
+        relay = None
         try:
+            if _redis is not None:
+                relay = asyncio.create_task(relay_session(session_id, buffer))
             yield {"event": "endpoint", "data": f"/messages/{session_id}"}
-            while True:
-                data = await queue.get()
-                yield {"event": "message", "data": json.dumps(data)}
+            while (item := await buffer.get()) is not None:
+                event, payload = item
+                yield {"event": event, "data": payload}
         except asyncio.CancelledError:
             pass
         finally:
+            if relay is not None:
+                relay.cancel()
             sessions.pop(session_id, None)
+            await buffer.close()
     
     return EventSourceResponse(event_generator())
 
+async def dispatch_rpc(session_id: str, body: dict):
+    """Ejecuta el metodo JSON-RPC y entrega la respuesta a la sesion, local o en otro worker."""
+    msg_id = body.get("id")
+    handler = RPC_METHODS.get(body.get("method", ""), rpc_unknown)
+    result = await handler(body)
+    if not msg_id:
+        return
+    
+    payload = rpc_envelope(msg_id, result)
+    buffer = sessions.get(session_id)
+    if buffer is not None:
+        await buffer.put(("message", payload.decode()))
+    elif _redis is not None:
+        await _redis.publish(session_channel(session_id), payload)
+
 async def messages_endpoint(request):
     session_id = request.path_params["session_id"]
-    if session_id not in sessions:
+    # Sesion local primero; si no, puede estar abierta en otro worker
+    if session_id not in sessions and not await session_exists(session_id):
         return Response("Session not found", status_code=404)
     
-    body = await request.json()
-    method = body.get("method", "")
-    msg_id = body.get("id")
-    
-    if method == "initialize":
-        response = {"jsonrpc": "2.0", "id": msg_id, "result": {"protocolVersion": "2024-11-05", "capabilities": {"tools": {}}, "serverInfo": {"name": "shopify-mcp", "version": "3.0.0"}}}
-    elif method == "tools/list":
-        response = {"jsonrpc": "2.0", "id": msg_id, "result": {"tools": TOOLS}}
-    elif method == "tools/call":
-        params = body.get("params", {})
-        name = params.get("name", "")
-        args = params.get("arguments", {})
-        result = await execute_tool(name, args)
-        response = {"jsonrpc": "2.0", "id": msg_id, "result": {"content": [{"type": "text", "text": result}]}}
-    else:
-        response = {"jsonrpc": "2.0", "id": msg_id, "result": {}}
-    
-    if response and msg_id:
-        await sessions[session_id].put(response)
-    
-    return Response("OK")
+    body = await read_json(request)
+    # ACK inmediato: la herramienta corre despues de enviar la respuesta HTTP
+    # y el resultado viaja por el stream SSE
+    return Response("OK", background=BackgroundTask(dispatch_rpc, session_id, body))
 
 async def health(request):
     return Response("OK")
 
-app = Starlette(routes=[
+@asynccontextmanager
+async def lifespan(app):
+    global _client, _redis
+    _client = httpx.AsyncClient(
+        base_url=BASE_URL,
+        headers=HEADERS,
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0),
+        http2=True
+    )
+    if REDIS_URL:
+        _redis = redis.from_url(REDIS_URL)
+    yield
+    await _client.aclose()
+    if _redis is not None:
+        await _redis.aclose()
+
+app = Starlette(lifespan=lifespan, routes=[
     Route("/", health),
     Route("/health", health),
     Route("/tools", http_tools),
@@ -803,4 +1180,16 @@ app = Starlette(routes=[
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 3000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # uvloop + httptools vienen con uvicorn[standard]. Con varios workers hace
+    # falta REDIS_URL (o afinidad de sesion en el balanceador) para que los POST
+    # a /messages lleguen al stream SSE correcto.
+    uvicorn.run(
+        "shopify_server:app",
+        host="0.0.0.0",
+        port=port,
+        workers=int(os.getenv("UVICORN_WORKERS", 1)),
+        loop="uvloop",
+        http="httptools",
+        log_level="warning",
+        access_log=False
+    )
\ No newline at end of file